@@ -1,14 +1,10 @@
 # ================= IMPORTS =================
 import streamlit as st
-import tempfile
-import librosa
-import soundfile as sf
-import whisper
-from pyannote.audio import Pipeline
-import random
+import hashlib
 import os
-import pandas as pd
+from pathlib import Path
 from huggingface_hub import login
+import pipeline
 
 # ================= PAGE CONFIG =================
 st.set_page_config(
@@ -62,8 +58,11 @@ st.write(
 )
 
 # ================= LOAD MODELS =================
+MODEL_SIZE = "distil-small.en"
+
+# Loaded once per process and shared by every session
 @st.cache_resource
-def load_models():
+def load_models(model_size=MODEL_SIZE):
     hf_token = st.secrets.get("HF_TOKEN")
 
     if not hf_token:
@@ -72,16 +71,87 @@ def load_models():
 
     login(token=hf_token)
 
-    diarization_pipeline = Pipeline.from_pretrained(
-        "pyannote/speaker-diarization-3.1"
-    )
+    return pipeline.load_models(model_size)
+
+
+diarization_pipeline, asr_pipeline = load_models()
+
+# ================= CACHED PROCESSING =================
+# Keyed on the SHA-256 of the upload and the pipeline config; arguments
+# starting with "_" are not hashed, so reruns on the same audio skip
+# diarization and transcription, while a model or parameter change does not
+# reuse stale results. Results are also persisted to disk so they survive
+# app restarts, and transcripts are stored per batch of clip boundaries.
+PIPELINE_CONFIG = pipeline.pipeline_config(MODEL_SIZE)
+
+
+DIARIZE_MAX_ENTRIES = 200
+TRANSCRIBE_MAX_ENTRIES = 2000
+
+
+@st.cache_data(
+    show_spinner=False,
+    persist="disk",
+    max_entries=DIARIZE_MAX_ENTRIES
+)
+def diarize(audio_hash, config, _audio, sr):
+    return pipeline.diarize(diarization_pipeline, _audio, sr)
+
 
-    whisper_model = whisper.load_model("base")
+@st.cache_data(
+    show_spinner=False,
+    persist="disk",
+    max_entries=TRANSCRIBE_MAX_ENTRIES
+)
+def transcribe(audio_hash, config, _audio, clips):
+    return pipeline.transcribe(asr_pipeline, _audio, clips)
+
+
+# max_entries only bounds the in-memory layer: Streamlit never deletes
+# persisted entries. Each function's files in ~/.streamlit/cache are named
+# "<function key>-<value key>.memo", so trim them per function to the same
+# limit. Reads do not touch a file's mtime, so the entries written longest
+# ago go first, not the least recently used ones
+CACHE_DIR = Path.home() / ".streamlit" / "cache"
 
-    return diarization_pipeline, whisper_model
 
+def prune_disk_cache(cached_func, max_entries):
+    cache_files = sorted(
+        CACHE_DIR.glob(f"{cached_func._function_key}-*.memo"),
+        key=os.path.getmtime
+    )
 
-diarization_pipeline, whisper_model = load_models()
+    for path in cache_files[:-max_entries]:
+        path.unlink(missing_ok=True)
+
+# ================= RESULTS =================
+# Rendered from session state, so results survive reruns, and isolated in a
+# fragment, so interacting with them reruns only this block instead of the
+# whole script
+@st.fragment
+def render_results():
+    diar_df, transcript_df = st.session_state["results"]
+
+    st.subheader("🗣️ Speaker Diarization Output (No Transcription)")
+    st.dataframe(
+        diar_df,
+        use_container_width=True,
+        hide_index=True
+    )
+
+    st.subheader("📝 Speaker-wise Transcript (Table View)")
+    st.dataframe(
+        transcript_df,
+        use_container_width=True,
+        hide_index=True
+    )
+
+    st.download_button(
+        "⬇️ Download Transcript (CSV)",
+        transcript_df.to_csv(index=False),
+        file_name="transcript.csv",
+        mime="text/csv"
+    )
 
 # ================= FILE UPLOAD =================
 uploaded_file = st.file_uploader(
@@ -90,45 +160,48 @@ uploaded_file = st.file_uploader(
 )
 
 if uploaded_file:
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".wav") as tmp:
-        tmp.write(uploaded_file.read())
-        audio_path = tmp.name
+    audio_bytes = uploaded_file.getvalue()
+    audio_hash = hashlib.sha256(audio_bytes).hexdigest()
 
     st.audio(uploaded_file)
     st.divider()
 
+    # Results belong to the upload they were computed for
+    if st.session_state.get("results_hash") != audio_hash:
+        st.session_state.pop("results", None)
+
     if st.button("🚀 Process Audio"):
         progress = st.progress(0)
         status = st.empty()
 
-        with st.spinner("Analyzing speakers and transcribing..."):
+        # Live output while processing; replaced by render_results() once
+        # everything is done
+        live = st.empty()
+
+        with live.container(), st.spinner(
+            "Analyzing speakers and transcribing..."
+        ):
 
             # -------- LOAD & NORMALIZE AUDIO --------
             status.write("🎧 Normalizing audio...")
-            audio, sr = librosa.load(audio_path, sr=16000, mono=True)
-            sf.write(audio_path, audio, sr)
+            try:
+                audio, sr = pipeline.load_audio(audio_bytes)
+            except pipeline.AudioDecodeError as error:
+                status.error(f"❌ {error}")
+                st.stop()
+
             progress.progress(20)
 
             # -------- SPEAKER DIARIZATION --------
             status.write("🔍 Running speaker diarization...")
-            annotation = diarization_pipeline({"audio": audio_path})
+            turns = diarize(audio_hash, PIPELINE_CONFIG, audio, sr)
             progress.progress(40)
 
             # -------- DISPLAY DIARIZATION ONLY (NO TRANSCRIPTION) --------
             status.write("📊 Displaying diarization results...")
-            
-            diarization_results = []
-            
-            for segment, _, speaker in annotation.itertracks(yield_label=True):
-                diarization_results.append({
-                    "Speaker": speaker,
-                    "Start Time (s)": round(segment.start, 2),
-                    "End Time (s)": round(segment.end, 2),
-                    "Duration (s)": round(segment.end - segment.start, 2)
-                })
-            
-            diar_df = pd.DataFrame(diarization_results)
-            
+
+            diar_df = pipeline.diarization_table(turns)
+
             st.subheader("🗣️ Speaker Diarization Output (No Transcription)")
             st.dataframe(
                 diar_df,
@@ -138,58 +211,46 @@ if uploaded_file:
 
 
             # -------- COLLECT RESULTS (COLAB LOGIC) --------
-            results = []
-
             status.write("📝 Transcribing segments...")
-            for segment, _, speaker in annotation.itertracks(yield_label=True):
-                start = int(segment.start * sr)
-                end = int(segment.end * sr)
-
-                segment_audio = audio[start:end]
-
-                # Skip very short segments (< 0.5s)
-                if len(segment_audio) < int(sr * 0.5):
-                    continue
-
-                with tempfile.NamedTemporaryFile(
-                    suffix=".wav", delete=False
-                ) as tmp_seg:
-                    sf.write(tmp_seg.name, segment_audio, sr)
-
-                transcription = whisper_model.transcribe(
-                    tmp_seg.name,
-                    fp16=False
-                )
-
-                os.remove(tmp_seg.name)
-
-                results.append({
-                    "speaker": speaker,
-                    "start": round(segment.start, 2),
-                    "end": round(segment.end, 2),
-                    "text": transcription["text"].strip()
-                })
-
-            progress.progress(80)
+            clips, results = pipeline.plan_clips(turns, audio, sr)
 
             # -------- DISPLAY AS TABLE --------
             st.subheader("📝 Speaker-wise Transcript (Table View)")
-
-            df = pd.DataFrame(results)
-
-            st.dataframe(
-                df,
-                use_container_width=True,
-                hide_index=True
-            )
+            table = st.empty()
+
+            # Decode batch by batch and refresh the table after each one, so
+            # early rows can be read while later ones are still decoding
+            for done in pipeline.transcribe_in_batches(
+                clips,
+                results,
+                lambda batch: transcribe(
+                    audio_hash,
+                    PIPELINE_CONFIG,
+                    audio,
+                    batch
+                )
+            ):
+                table.dataframe(
+                    pipeline.transcript_table(results[:done]),
+                    use_container_width=True,
+                    hide_index=True
+                )
+                progress.progress(40 + int(60 * done / len(clips)))
 
             progress.progress(100)
             status.success("✅ Processing complete!")
 
-        st.balloons()
+        st.session_state["results"] = (
+            diar_df,
+            pipeline.transcript_table(results)
+        )
+        st.session_state["results_hash"] = audio_hash
 
-    # -------- CLEANUP --------
-    if os.path.exists(audio_path):
-        os.remove(audio_path)
+        prune_disk_cache(diarize, DIARIZE_MAX_ENTRIES)
+        prune_disk_cache(transcribe, TRANSCRIBE_MAX_ENTRIES)
 
+        live.empty()
+        st.balloons()
 
+    if "results" in st.session_state:
+        render_results()
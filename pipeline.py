@@ -0,0 +1,509 @@
+# ================= IMPORTS =================
+import io
+import os
+import math
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pandas as pd
+import soundfile as sf
+import soxr
+import torch
+import torch.nn.functional as F
+from faster_whisper import WhisperModel, BatchedInferencePipeline
+from pyannote.audio import Pipeline
+from pyannote.audio.models.embedding.wespeaker import BaseWeSpeakerResNet
+
+# Number of Whisper sub-batches decoded in parallel on CPU, each on its own
+# CTranslate2 worker. Every worker holds its own copy of the model and gets
+# an equal share of the cores, so it defaults to 1 (one batch on all cores)
+# until more workers are measured to be faster on the target machine. On
+# GPU every extra worker is another model copy in the same device memory,
+# so a single worker is always used there
+try:
+    MAX_CONCURRENT_JOBS = max(
+        1,
+        int(os.environ.get("WHISPER__MAX_CONCURRENT_JOBS", "1"))
+    )
+except ValueError:
+    MAX_CONCURRENT_JOBS = 1
+
+# Step of the diarization sliding window, as a ratio of its 10s duration.
+# Defaults to pyannote's 0.1 (90% overlap). Coarser steps (e.g. 0.5) run
+# proportionally fewer segmentation and embedding forwards, at a diarization
+# accuracy cost that should be measured on your own audio first
+try:
+    SEGMENTATION_STEP = float(
+        os.environ.get("DIARIZATION__SEGMENTATION_STEP", "0.1")
+    )
+except ValueError:
+    SEGMENTATION_STEP = 0.1
+
+# Non-positive (or NaN) steps make no sliding window at all, and steps
+# above 1 leave gaps between windows that no chunk covers
+if not SEGMENTATION_STEP > 0:
+    SEGMENTATION_STEP = 0.1
+
+SEGMENTATION_STEP = min(SEGMENTATION_STEP, 1.0)
+
+# Clustering hyper-parameters of the pretrained 3.1 pipeline.
+# min_cluster_size is counted in embeddings, one per chunk a speaker is
+# active in, so it shrinks with the number of chunks when the step is
+# coarsened; otherwise speakers who talk little would fall below it and be
+# merged into a larger cluster. pyannote accepts values in [1, 20]
+CLUSTERING = {
+    "method": "centroid",
+    "min_cluster_size": min(20, max(1, round(12 * 0.1 / SEGMENTATION_STEP))),
+    "threshold": 0.7045654963945799
+}
+
+# Run the embedding conv backbone under FP16 autocast on GPU. Off by
+# default: FP16 embeddings have not yet been compared against FP32 on the
+# pretrained weights, so opt in only after checking diarization output
+EMBEDDING_FP16 = os.environ.get(
+    "DIARIZATION__EMBEDDING_FP16", ""
+).strip().lower() in ("1", "true", "yes")
+
+# Clips quieter than this RMS are not sent to Whisper
+SILENCE_RMS = 0.005
+
+# Bump whenever a code change alters diarization or transcription output,
+# so results the app cached on disk with older code are not served
+PIPELINE_VERSION = 1
+
+
+def pipeline_config(model_size):
+    # Everything besides the audio that shapes the output; the app keys its
+    # cached results on it, so changing any of these invalidates them
+    return {
+        "version": PIPELINE_VERSION,
+        "model_size": model_size,
+        "segmentation_step": SEGMENTATION_STEP,
+        "clustering": CLUSTERING,
+        "embedding_fp16": EMBEDDING_FP16 and torch.cuda.is_available(),
+        "silence_rms": SILENCE_RMS
+    }
+
+# ================= EMBEDDING BACKBONE SHARING =================
+# pyannote embeds every (chunk, local speaker) pair separately, so each 10s
+# chunk goes through fbank + ResNet once per local speaker (3 times) with
+# only the pooling mask changing. Patch the WeSpeaker model to run the
+# backbone once per distinct chunk and pool it once per mask.
+def share_embedding_backbone(
+    embedding_model,
+    compile_backbone=False,
+    fp16=False
+):
+    resnet = embedding_model.resnet
+    full_forward = embedding_model.forward
+
+    # The stock forward returns the single seg_1 embedding only when there
+    # is no second embedding layer, which is what forward() below reproduces
+    assert not resnet.two_emb_layer, "expected a single embedding layer"
+
+    def backbone(fbank):
+        # ResNet.forward up to (not including) the pooling layer. With fp16
+        # only this conv stack runs under autocast: the fbank front-end
+        # scales waveforms by 2**15 and its mel projection overflows FP16,
+        # so fbank, pooling and the embedding layer always stay in FP32
+        with torch.autocast(
+            "cuda",
+            dtype=torch.float16,
+            enabled=fp16 and fbank.is_cuda
+        ):
+            out = fbank.permute(0, 2, 1).unsqueeze(1)
+            out = F.relu(resnet.bn1(resnet.conv1(out)))
+            out = resnet.layer1(out)
+            out = resnet.layer2(out)
+            out = resnet.layer3(out)
+            out = resnet.layer4(out)
+
+        return out.float()
+
+    if compile_backbone:
+        # The number of distinct chunks changes from batch to batch
+        backbone = torch.compile(backbone, dynamic=True)
+
+    def forward(waveforms, weights=None):
+        if weights is None:
+            return full_forward(waveforms)
+
+        # Rows of the same chunk are consecutive and carry the same waveform
+        new_chunk = torch.ones(
+            waveforms.shape[0],
+            dtype=torch.bool,
+            device=waveforms.device
+        )
+        new_chunk[1:] = (waveforms[1:] != waveforms[:-1]).flatten(1).any(dim=1)
+        chunk_index = torch.cumsum(new_chunk, dim=0) - 1
+
+        # An all-zero mask pools to exactly zero statistics, so rows of
+        # inactive speakers (and chunks with no active speaker at all) need
+        # no backbone pass
+        rows = torch.nonzero(weights.sum(dim=1) > 0).squeeze(1)
+
+        if rows.numel() == 0:
+            return resnet.seg_1(
+                waveforms.new_zeros(waveforms.shape[0], resnet.pool_out_dim)
+            )
+
+        chunks = torch.unique(chunk_index[rows])
+        features = backbone(
+            embedding_model.compute_fbank(waveforms[new_chunk][chunks])
+        )
+
+        pooled = resnet.pool(
+            features[torch.searchsorted(chunks, chunk_index[rows])],
+            weights=weights[rows]
+        )
+
+        stats = pooled.new_zeros(waveforms.shape[0], pooled.shape[1])
+        stats[rows] = pooled
+
+        return resnet.seg_1(stats)
+
+    embedding_model.forward = forward
+
+# ================= LOAD MODELS =================
+# model_size is any faster-whisper model name; the default is the distilled
+# English-only Whisper
+def load_models(model_size="distil-small.en"):
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+    diarization_pipeline = Pipeline.from_pretrained(
+        "pyannote/speaker-diarization-3.1"
+    )
+    diarization_pipeline.to(device)
+
+    # The pipeline only reads segmentation_step when it is built, so the
+    # window step has to be set on its Inference object directly
+    segmentation = diarization_pipeline._segmentation
+    diarization_pipeline.segmentation_step = SEGMENTATION_STEP
+    segmentation.step = SEGMENTATION_STEP * segmentation.duration
+
+    diarization_pipeline.instantiate({"clustering": CLUSTERING})
+
+    # Every chunk is 10s long, so conv input shapes only vary in batch size:
+    # segmentation batches are fixed, and the shared embedding backbone sees
+    # between 1 and embedding_batch_size distinct chunks. cuDNN benchmarks
+    # each of those few shapes once and reuses the fastest algorithm after
+    if device.type == "cuda":
+        torch.backends.cudnn.benchmark = True
+
+    # Whisper runs on CTranslate2, so the torch model worth compiling is
+    # pyannote's embedding ResNet: it dominates diarization time. Warm it
+    # up here, under the same inference mode as diarize(), so the first
+    # upload does not pay the compile cost
+    torch_version = tuple(int(v) for v in torch.__version__.split(".")[:2])
+    compile_backbone = device.type == "cuda" and torch_version >= (2, 1)
+
+    embedding_model = diarization_pipeline._embedding.model_
+
+    if isinstance(embedding_model, BaseWeSpeakerResNet):
+        share_embedding_backbone(
+            embedding_model,
+            compile_backbone,
+            fp16=EMBEDDING_FP16 and device.type == "cuda"
+        )
+
+        if compile_backbone:
+            batch_size = diarization_pipeline.embedding_batch_size
+
+            with torch.inference_mode():
+                embedding_model(
+                    torch.randn(
+                        batch_size, 1, int(segmentation.duration * 16000),
+                        device=device
+                    ),
+                    weights=torch.ones(
+                        batch_size,
+                        segmentation.model.example_output.num_frames,
+                        device=device
+                    )
+                )
+
+    # Fused FlashAttention-2 kernels need an Ampere (sm_80) or newer GPU
+    use_flash_attention = (
+        device.type == "cuda"
+        and torch.cuda.get_device_capability(device)[0] >= 8
+    )
+
+    # FP16 on GPU, INT8 on CPU. CTranslate2 runs its kernels outside the
+    # GIL on a fixed thread pool (4 threads by default), so split every
+    # core between the concurrent workers
+    def build_whisper(flash_attention):
+        return WhisperModel(
+            model_size,
+            device=device.type,
+            compute_type="float16" if device.type == "cuda" else "int8",
+            cpu_threads=max(1, (os.cpu_count() or 4) // concurrent_jobs()),
+            num_workers=concurrent_jobs(),
+            flash_attention=flash_attention
+        )
+
+    try:
+        whisper_model = build_whisper(use_flash_attention)
+    except (RuntimeError, ValueError):
+        if not use_flash_attention:
+            raise
+
+        # The PyPI ctranslate2 wheels are built without FlashAttention and
+        # reject the flag at load time; fall back to the standard kernels
+        whisper_model = build_whisper(False)
+
+    asr_pipeline = BatchedInferencePipeline(model=whisper_model)
+
+    # Decode one second of silence so buffer allocation and kernel setup
+    # happen here, behind the model cache, instead of on the first upload
+    transcribe_batch(
+        asr_pipeline,
+        np.zeros(16000, dtype=np.float32),
+        [(0, 16000)]
+    )
+
+    return diarization_pipeline, asr_pipeline
+
+# ================= AUDIO LOADING =================
+# Raised with a readable message when an upload cannot be decoded at all
+class AudioDecodeError(RuntimeError):
+    pass
+
+
+# Decodes straight from the uploaded bytes, so nothing touches the disk
+def load_audio(audio_bytes, sr=16000):
+    try:
+        audio, file_sr = sf.read(
+            io.BytesIO(audio_bytes),
+            dtype="float32",
+            always_2d=False
+        )
+    except sf.LibsndfileError:
+        # Formats libsndfile cannot read: pipe the bytes through ffmpeg and
+        # let it decode straight to 16 kHz mono float32 PCM on stdout
+        try:
+            decoded = subprocess.run(
+                [
+                    "ffmpeg", "-loglevel", "error",
+                    "-i", "pipe:0",
+                    "-ar", str(sr), "-ac", "1", "-f", "f32le", "-"
+                ],
+                input=audio_bytes,
+                capture_output=True,
+                check=True
+            )
+        except FileNotFoundError:
+            raise AudioDecodeError(
+                "soundfile cannot decode this audio format and ffmpeg, "
+                "needed as a fallback, is not installed"
+            ) from None
+        except subprocess.CalledProcessError as failed:
+            raise AudioDecodeError(
+                "ffmpeg could not decode this audio: "
+                + failed.stderr.decode(errors="replace").strip()
+            ) from None
+
+        # frombuffer over bytes is read-only, which torch.from_numpy warns
+        # about in diarize(); decode into a writable bytearray instead
+        return np.frombuffer(bytearray(decoded.stdout), dtype=np.float32), sr
+
+    if audio.ndim == 2:
+        audio = audio.mean(axis=1)
+
+    if file_sr != sr:
+        audio = soxr.resample(audio, file_sr, sr)
+
+    return audio, sr
+
+# ================= DIARIZATION =================
+def diarize(diarization_pipeline, audio, sr):
+    # Hand pyannote the decoded waveform so it does not re-read the file.
+    # The whole call runs without autograd, not just the network forwards
+    # pyannote guards itself. FP16 is confined to the embedding backbone
+    # (see share_embedding_backbone); everything else keeps full precision
+    with torch.inference_mode():
+        annotation = diarization_pipeline({
+            "waveform": torch.from_numpy(audio).unsqueeze(0),
+            "sample_rate": sr
+        })
+
+    return [
+        (segment.start, segment.end, speaker)
+        for segment, _, speaker in annotation.itertracks(yield_label=True)
+    ]
+
+# ================= TRANSCRIPTION =================
+def plan_clips(turns, audio, sr):
+    results = []
+    clips = []
+
+    # Merge consecutive turns of the same speaker separated by < 2s of
+    # silence: Whisper is faster and more accurate on longer context
+    runs = []
+
+    for seg_start, seg_end, speaker in turns:
+        if (
+            runs
+            and runs[-1][2] == speaker
+            and seg_start - runs[-1][1] < 2.0
+            and seg_end - runs[-1][0] <= 30
+        ):
+            runs[-1][1] = max(runs[-1][1], seg_end)
+        else:
+            runs.append([seg_start, seg_end, speaker])
+
+    # Batched Whisper only decodes the first 30s of each clip
+    max_clip = 30 * sr
+
+    # Convert every run to sample indices at once, then drop the short ones
+    # with a single mask before any audio is sliced
+    bounds = np.array(
+        [(run_start, run_end) for run_start, run_end, _ in runs],
+        dtype=np.float64
+    ).reshape(-1, 2)
+    bounds = (bounds * sr).astype(np.int64)
+
+    # Skip very short segments (< 0.5s)
+    min_clip = int(sr * 0.5)
+    keep = np.flatnonzero(bounds[:, 1] - bounds[:, 0] >= min_clip)
+
+    for idx in keep:
+        start, end = bounds[idx].tolist()
+        speaker = runs[idx][2]
+
+        for clip_start in range(start, end, max_clip):
+            clip_end = min(clip_start + max_clip, end)
+
+            # The 30s split can leave a short tail, which gets the same
+            # length filter as a whole run
+            if clip_end - clip_start < min_clip:
+                continue
+
+            # Cheap energy VAD: near-silent clips only make Whisper
+            # hallucinate, so skip them. The threshold is kept low so quiet
+            # speech is never dropped
+            clip = audio[clip_start:clip_end]
+            if np.sqrt(np.mean(np.square(clip))) < SILENCE_RMS:
+                continue
+
+            clips.append((clip_start, clip_end))
+            results.append({
+                "speaker": speaker,
+                "start": round(clip_start / sr, 2),
+                "end": round(clip_end / sr, 2)
+            })
+
+    return clips, results
+
+
+def transcription_batch_size():
+    # GPUs have the memory to take wider batches
+    return 24 if torch.cuda.is_available() else 16
+
+
+def concurrent_jobs():
+    # Extra CTranslate2 workers only pay off on CPU (see MAX_CONCURRENT_JOBS)
+    return 1 if torch.cuda.is_available() else MAX_CONCURRENT_JOBS
+
+
+def transcribe_in_batches(clips, results, transcribe_fn):
+    # Fill in results[i]["text"] one batch of clips at a time and yield how
+    # many results are done after each batch, so callers can render
+    # progressively. transcribe_fn maps a tuple of clips to their texts
+    size = transcription_batch_size()
+
+    for i in range(0, len(clips), size):
+        texts = transcribe_fn(tuple(clips[i:i + size]))
+
+        for result, text in zip(results[i:i + size], texts):
+            result["text"] = text
+
+        yield min(i + size, len(clips))
+
+
+def transcribe(asr_pipeline, audio, clips):
+    jobs = concurrent_jobs()
+
+    if jobs == 1 or len(clips) < 2:
+        return transcribe_batch(asr_pipeline, audio, clips)
+
+    # Split the batch across the CTranslate2 workers. Decoding releases the
+    # GIL, so threads run in parallel without a process per model copy
+    size = math.ceil(len(clips) / jobs)
+    parts = [clips[i:i + size] for i in range(0, len(clips), size)]
+
+    with ThreadPoolExecutor(max_workers=len(parts)) as executor:
+        texts = executor.map(
+            lambda part: transcribe_batch(asr_pipeline, audio, part),
+            parts
+        )
+
+        return [text for part_texts in texts for text in part_texts]
+
+
+def transcribe_batch(asr_pipeline, audio, clips):
+    # One batched call over the whole waveform, clipped per segment. Each
+    # clip is padded to a 30s window and stacked, so a batch is one encoder
+    # forward
+    segments, _ = asr_pipeline.transcribe(
+        audio,
+        clip_timestamps=[{"start": start, "end": end} for start, end in clips],
+        vad_filter=False,
+        # Greedy, single-pass decoding: no beam search, no temperature
+        # fallback re-decodes and no prompt carried between clips
+        beam_size=1,
+        best_of=1,
+        temperature=0.0,
+        condition_on_previous_text=False,
+        without_timestamps=True,
+        batch_size=len(clips)
+    )
+
+    # Without timestamps every clip decodes to a single segment
+    return [seg.text.strip() for seg in segments]
+
+# ================= RESULT TABLES =================
+def diarization_table(turns):
+    # Build the table column-wise instead of one dict per turn
+    diar_df = pd.DataFrame(
+        turns,
+        columns=["Start Time (s)", "End Time (s)", "Speaker"]
+    )
+    diar_df["Duration (s)"] = (
+        diar_df["End Time (s)"] - diar_df["Start Time (s)"]
+    )
+
+    return diar_df[
+        ["Speaker", "Start Time (s)", "End Time (s)", "Duration (s)"]
+    ].round(2)
+
+
+def transcript_table(results):
+    # Same column names as the diarization table
+    return pd.DataFrame(
+        results,
+        columns=["speaker", "start", "end", "text"]
+    ).rename(columns={
+        "speaker": "Speaker",
+        "start": "Start Time (s)",
+        "end": "End Time (s)",
+        "text": "Text"
+    })
+
+# ================= FULL PIPELINE =================
+# Headless entry point: pass already loaded models to reuse them, otherwise
+# they are loaded for model_size
+def run_pipeline(audio_bytes, model_size="distil-small.en", models=None):
+    diarization_pipeline, asr_pipeline = models or load_models(model_size)
+
+    audio, sr = load_audio(audio_bytes)
+    turns = diarize(diarization_pipeline, audio, sr)
+    clips, results = plan_clips(turns, audio, sr)
+
+    for _ in transcribe_in_batches(
+        clips,
+        results,
+        lambda batch: transcribe(asr_pipeline, audio, batch)
+    ):
+        pass
+
+    return diarization_table(turns), transcript_table(results)
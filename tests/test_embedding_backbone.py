@@ -0,0 +1,57 @@
+import torch
+from pyannote.audio.models.embedding.wespeaker import WeSpeakerResNet34
+
+import pipeline
+
+
+def make_batch(num_chunks=4, num_speakers=3, num_frames=589):
+    # pyannote's layout: one row per (chunk, local speaker), rows of the same
+    # chunk consecutive and sharing the chunk's waveform
+    generator = torch.Generator().manual_seed(0)
+
+    waveforms = []
+    weights = []
+
+    for c in range(num_chunks):
+        waveform = 0.1 * torch.randn(1, 160000, generator=generator)
+
+        for s in range(num_speakers):
+            waveforms.append(waveform)
+
+            # Inactive local speakers, and one chunk with no speech at all
+            if c == 1 or (c + s) % 3 == 0:
+                weights.append(torch.zeros(num_frames))
+            else:
+                weights.append(
+                    (torch.rand(num_frames, generator=generator) > 0.5).float()
+                )
+
+    return torch.stack(waveforms), torch.stack(weights)
+
+
+def test_shared_backbone_matches_stock_forward():
+    torch.manual_seed(0)
+    model = WeSpeakerResNet34().eval()
+
+    waveforms, weights = make_batch()
+
+    # Start and end mid-chunk, as batches cut across chunk boundaries
+    waveforms, weights = waveforms[1:-1], weights[1:-1]
+    all_inactive = torch.zeros_like(weights[:3])
+
+    with torch.inference_mode():
+        expected = model(waveforms, weights=weights)
+        expected_inactive = model(waveforms[:3], weights=all_inactive)
+
+        pipeline.share_embedding_backbone(model)
+
+        actual = model(waveforms, weights=weights)
+        actual_inactive = model(waveforms[:3], weights=all_inactive)
+
+    torch.testing.assert_close(actual, expected, rtol=0, atol=0)
+    torch.testing.assert_close(
+        actual_inactive,
+        expected_inactive,
+        rtol=0,
+        atol=0
+    )